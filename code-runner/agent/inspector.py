@@ -2,15 +2,25 @@ import sys
 import traceback
 import multiprocessing
 import importlib
-import tracemalloc
 import time
+import resource
 import builtins
+import functools
+import itertools
 import argparse
 import json
 import cProfile
+import hashlib
 import pstats
+import os
+import select
+import signal
+import ctypes
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import CodeType
 from typing import TypedDict, Optional, Callable, Any
-from utils import LimitedStream
+from utils import LimitedStream, MemorySampler, write_frame, read_frame
 
 
 # TYPES
@@ -25,10 +35,22 @@ class CodeResult(TypedDict):
     error: Optional[str]
     truncated: bool
     memory_peak_mb: Optional[float]
+    memory_timeline: Optional[list]
     execution_time: Optional[float]
     variables: Optional[dict]
     hotspots: list
 
+# a dict keeps the order, and dict.fromkeys(dict) is presized
+_RESULT_KEYS = dict.fromkeys(CodeResult.__annotations__)
+
+
+@dataclass(slots=True)
+class VarInfo:
+    # serialized by orjson as a dict when the result is sent
+    type: str
+    value_preview: str
+    shape: Optional[list]
+
 
 # HELPERS
 
@@ -47,57 +69,98 @@ def resolve_target(full_path: str) -> tuple[Any, str]:
     
     module_name = parts[0]
     try:
-        obj = importlib.import_module(module_name)
+        obj = sys.modules.get(module_name) or importlib.import_module(module_name)
     except ImportError:
         return None, ""
     
     # go through the chain of attributes to the penultimate element
     # example: pandas.DataFrame.apply -> (DataFrame, 'apply')
-    for part in parts[1:-1]:
-        if not hasattr(obj, part):
-            return None, "" # path not found
-        obj = getattr(obj, part)
-    
+    try:
+        obj = functools.reduce(getattr, parts[1:-1], obj)
+    except AttributeError:
+        return None, "" # path not found
+
     target_attr_name = parts[-1]
     return obj, target_attr_name
 
 
+# resolved in the zygote and shared by every worker forked after: (path, reason) -> (target object, attribute name, trap)
+_resolved_rules: dict[tuple[str, str], Optional[tuple[Any, str, Callable]]] = {}
+
+
+def resolve_rule(rule: ForbiddenMethod) -> Optional[tuple[Any, str, Callable]]:
+    """Resolves the target of a rule and creates its trap, reusing earlier results"""
+    key = (rule["path"], rule["reason"])
+    if key not in _resolved_rules:
+        target_obj, attr_name = resolve_target(rule["path"])
+        if target_obj is not None and hasattr(target_obj, attr_name):
+            _resolved_rules[key] = (target_obj, attr_name, create_forbidden_trigger(rule["reason"]))
+        else:
+            _resolved_rules[key] = None
+    return _resolved_rules[key]
+
+
+def _str_trunc(value: str, max_len: int) -> str:
+    return value[:max_len] + "..." if len(value) > max_len else value
+
+
+# exact type -> preview, one dict lookup instead of comparing against each type
+_REPRS = {int: str, float: str, bool: str, type(None): str}
+
+
 def safe_repr(value, max_len=100):
     """Safely getting a string representation of an object"""
     try:
         t = type(value)
-        if t in (int, float, bool, type(None)):
-            return str(value)
-        
+        fn = _REPRS.get(t)
+        if fn is not None:
+            return fn(value)
+
         if t is str:
-            return value[:max_len] + "..." if len(value) > max_len else value
-        
+            return _str_trunc(value, max_len)
+
         return f"<{t.__name__} object>"
     except Exception:
          return "<Error getting value>"
 
 
-def serialize_variables(locals_dict: dict[str, any], max_vars=50) -> dict:
-    clean_vars = {}
-    count = 0
+def _describe_plain(value) -> VarInfo:
+    """Built-in types that never have a shape"""
+    return VarInfo(type(value).__name__, safe_repr(value), None)
 
-    for name, value in locals_dict.items():
-        if count >= max_vars:
-            break
-        if name.startswith('__') or name in ['safe_import', 'builtins', 'sys']:
-            continue
 
-        clean_vars[name] = {
-            "type": type(value).__name__,
-            "value_preview": safe_repr(value),
-            "shape": list(value.shape) if hasattr(value, 'shape') and not callable(value.shape) else None
-        }
-        count += 1
-    return clean_vars
+def _describe_generic(value) -> VarInfo:
+    """Anything else: arrays and dataframes have a shape"""
+    try:
+        shape = list(value.shape)
+    except Exception:
+        shape = None
+    return VarInfo(type(value).__name__, safe_repr(value), shape)
+
+
+# exact type -> describer, to avoid probing attributes of common values
+_DESCRIBERS: dict[type, Callable[[Any], VarInfo]] = {
+    t: _describe_plain for t in (int, float, bool, complex, str, bytes, list, tuple, dict, set, frozenset, type(None))
+}
+
+
+def serialize_variables(locals_dict: dict[str, any], max_vars=50) -> dict[str, VarInfo]:
+    visible = (
+        (name, value) for name, value in locals_dict.items()
+        if not name.startswith('__') and name not in ('safe_import', 'builtins', 'sys')
+    )
+    return {
+        name: _DESCRIBERS.get(type(value), _describe_generic)(value)
+        for name, value in itertools.islice(visible, max_vars)
+    }
 
 
 def get_hotspots(profile: cProfile.Profile):
-    ps = pstats.Stats(profile)
+    try:
+        ps = pstats.Stats(profile)
+    except TypeError:
+        # nothing was profiled: the code didn't compile
+        return []
     hotspots = []
     for func_tuple, stats in ps.stats.items():
         file_name, line, func = func_tuple
@@ -118,59 +181,93 @@ def get_hotspots(profile: cProfile.Profile):
         hotspots.sort(key=lambda x: x['time'], reverse=True)
         return hotspots
 
+# code objects of recent submissions, compiled in the zygote and shared by the workers
+COMPILE_CACHE_SIZE = 256
+MAX_CACHED_CODE_CHARS = 64 * 1024
+_compiled_code: OrderedDict[bytes, CodeType] = OrderedDict()
+
+
+def _code_key(user_code: str) -> bytes:
+    return hashlib.blake2b(user_code.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def compile_cached(user_code: str) -> CodeType:
+    """Compiles user's code, reusing the code object of an identical earlier submission"""
+    if len(user_code) > MAX_CACHED_CODE_CHARS:
+        return compile(user_code, "<student_code>", "exec")
+
+    key = _code_key(user_code)
+    compiled_code = _compiled_code.get(key)
+    if compiled_code is None:
+        compiled_code = compile(user_code, "<student_code>", "exec")
+        _compiled_code[key] = compiled_code
+        if len(_compiled_code) > COMPILE_CACHE_SIZE:
+            _compiled_code.popitem(last=False)
+    else:
+        _compiled_code.move_to_end(key)
+    return compiled_code
+
+
 def safe_import(name, *args, **kwargs):
     if name in ['os', 'subprocess', 'shutil', 'sys', 'importlib', 'inspect']:
         raise ImportError(f"Security: Import of '{name}' is forbidden.")
     return __import__(name, *args, **kwargs)
 
 
+# builtins without the dangerous functions, built once per process
+_SAFE_BUILTINS = {
+    name: value for name, value in builtins.__dict__.items()
+    if name not in ('open', 'exec', 'eval', 'quit', 'exit')
+}
+_SAFE_BUILTINS['__import__'] = safe_import
+
+
 # WORKER
 
-def worker_process(user_code: str, blacklist: list[ForbiddenMethod], return_queue: multiprocessing.Queue) -> None:
+def _reset_peak_rss() -> None:
+    """Resets the peak RSS of the worker (Linux only), so that it covers a single submission"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _run_worker(user_code: str, blacklist: list[ForbiddenMethod], track_memory: bool) -> CodeResult:
     """
-    executes user's code and puts the result into the queue
+    executes user's code and returns the result.
+    The peak memory is taken from getrusage, with track_memory
+    the memory is also sampled over time
     """
 
     # Save tracing tools before patching
     _timer = time.perf_counter
-    _trace_start = tracemalloc.start
-    _trace_stop = tracemalloc.stop
-    _trace_get = tracemalloc.get_traced_memory
+    _rusage = resource.getrusage
+    sampler = MemorySampler() if track_memory else None
+    _reset_peak_rss()
 
     profile = cProfile.Profile()
 
-    result: CodeResult = {
-        "success": False,
-        "output": "",
-        "error": None,
-        "truncated": False,
-        "memory_peak_mb": 0,
-        "execution_time": 0,
-        "variables": {},
-        "hotspots": []
-    }
+    # the rest of the fields are always filled in at the end
+    result: CodeResult = dict.fromkeys(_RESULT_KEYS)
+    result["success"] = False
+    result["variables"] = {}
 
     # Monkey Patching
     for rule in blacklist:
-        target_obj, attr_name = resolve_target(rule["path"])
-        if target_obj is not None and hasattr(target_obj, attr_name):
-            try:
-                trap = create_forbidden_trigger(rule["reason"])
-                setattr(target_obj, attr_name, trap)
-            except:
-                # Some built-in types (str) cannot be patched in CPython.
-                pass
-
-
-    safe_builtins = builtins.__dict__.copy()
-    safe_builtins['__import__'] = safe_import
+        resolved = resolve_rule(rule)
+        if resolved is None:
+            continue
+        target_obj, attr_name, trap = resolved
+        try:
+            setattr(target_obj, attr_name, trap)
+        except:
+            # Some built-in types (str) cannot be patched in CPython.
+            pass
 
-    # remove dangerous functions from builtins 
-    for dangerous in ['open', 'exec', 'eval', 'quit', 'exit']:
-         if dangerous in safe_builtins:
-             del safe_builtins[dangerous]
 
-    user_globals = {'__builtins__': safe_builtins, '__name__': '__main__'}
+    # the worker only lives for this submission, so the template can be used as is
+    user_globals = {'__builtins__': _SAFE_BUILTINS, '__name__': '__main__'}
     user_locals = {}
 
     # capture stdout/stderr to memory
@@ -178,25 +275,30 @@ def worker_process(user_code: str, blacklist: list[ForbiddenMethod], return_queu
     sys.stdout = captured_output
     sys.stderr = captured_output
 
-    _trace_start()
+    if sampler:
+        sampler.start()
+    rss_before = _rusage(resource.RUSAGE_SELF).ru_maxrss
     start_time = _timer()
     try:
         # Compile separately to distinguish SyntaxError from Runtime Errors
-        compiled_code = compile(user_code, "<student_code>", "exec")
+        compiled_code = compile_cached(user_code)
         profile.enable()
         exec(compiled_code, user_globals, user_locals)
+        # keep serialize_variables out of the hotspots
+        profile.disable()
         result['success'] = True
         result['variables'] = serialize_variables(user_locals)
-    except Exception:
-        tb_list = traceback.extract_tb(sys.exc_info()[2])
+    except Exception as e:
+        tb_list = traceback.extract_tb(e.__traceback__)
         clean_tb = [frame for frame in tb_list if frame.filename == '<student_code>']
-        error_msg = f"{type(sys.exc_info()[1]).__name__}: {sys.exc_info()[1]}"
-        result['error'] = "".join(traceback.format_list(clean_tb)) + error_msg
+        result['error'] = "".join(traceback.format_list(clean_tb)) + f"{type(e).__name__}: {e}"
     finally:
         end_time = _timer()
         profile.disable()
-        _, peak = _trace_get()
-        _trace_stop()
+        # ru_maxrss is in kilobytes
+        peak = max(_rusage(resource.RUSAGE_SELF).ru_maxrss - rss_before, 0) * 1024
+        if sampler:
+            result["memory_timeline"] = sampler.stop()
 
         sys.stdout = sys.__stdout__
         sys.stderr = sys.__stderr__
@@ -207,65 +309,196 @@ def worker_process(user_code: str, blacklist: list[ForbiddenMethod], return_queu
         result['execution_time'] = end_time - start_time
         result['hotspots'] = get_hotspots(profile)[:5]
 
-        return_queue.put(result)
+        return result
 
-    
 
-def universal_inspector(user_code: str, blacklist: list[ForbiddenMethod], timeout_seconds=2) -> CodeResult:
-    queue = multiprocessing.Queue() # contains the result of the user_code
+def worker_process(result_fd: int, private_fds: list[int], user_code: str, blacklist: list[ForbiddenMethod], track_memory: bool) -> None:
+    """
+    runs a single submission in a freshly forked process and sends back the result
+    """
+    # its own process group, so the zygote can kill whatever the submission starts
+    os.setsid()
+    # the submission must not get hold of the zygote's fds (e.g. the serve FIFOs)
+    for fd in private_fds:
+        os.close(fd)
+    write_frame(result_fd, _run_worker(user_code, blacklist, track_memory))
 
-    process = multiprocessing.Process(target=worker_process, args=(user_code, blacklist, queue))
-    process.start()
-    process.join(timeout=timeout_seconds)
 
-    if process.is_alive():
-        # if the process is still alive after the timeout, it is stuck.
-        process.terminate() # kill (SIGTERM)
-        process.join()
-        return {
-            "success": False,
-            "error": "Time Limit Exceeded: Ваш код выполнялся слишком долго.",
-            "output": "",
-            "truncated": False,
-            "memory_peak_mb": None,
-            "execution_time": timeout_seconds,
-            "variables": {},
-            "hotspots": []
-        }
-    
-    # If the process has completed itself, take the result from the queue.
-    if not queue.empty():
-        return queue.get()
-    else:
-        # if the process crashed fatally (segfault)
-        return {
-            "success": False,
-            "error": "System Error: Process crashed",
-            "output": "",
-            "truncated": False,
-            "memory_peak_mb": None,
-            "execution_time": None,
-            "variables": {},
-            "hotspots": []
-        }
+def _warm_caches(user_code: str, blacklist: list[ForbiddenMethod]) -> None:
+    """Compiles the code and resolves the rules in the zygote, so that later workers inherit them"""
+    try:
+        for rule in blacklist:
+            resolve_rule(rule)
+        # code too big for the cache is compiled by the worker, inside its time limit
+        if len(user_code) <= MAX_CACHED_CODE_CHARS:
+            key = _code_key(user_code)
+            if key in _compiled_code:
+                # keeps a repeated submission from being evicted
+                _compiled_code.move_to_end(key)
+            else:
+                compile_cached(user_code)
+    except Exception:
+        # the worker runs into the same error and reports it
+        pass
+
+
+def _failed_result(error: str, execution_time: Optional[float]) -> CodeResult:
+    return {
+        "success": False,
+        "error": error,
+        "output": "",
+        "truncated": False,
+        "memory_peak_mb": None,
+        "memory_timeline": None,
+        "execution_time": execution_time,
+        "variables": {},
+        "hotspots": []
+    }
+
+
+# imported by the long-lived serve process before the workers are forked,
+# so neither submissions nor blacklist rules pay for the first import
+PREIMPORT = [
+    'numpy', 'pandas', 'sklearn',
+    'math', 'random', 'statistics', 'time', 'datetime',
+    'collections', 'itertools', 'functools', 're', 'json',
+]
+
+
+def preimport_modules() -> None:
+    for module_name in PREIMPORT:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+
+
+class Zygote:
+    """
+    Keeps the imports and caches in one long-lived process and forks
+    a fresh worker from it for every submission: nothing a submission changes
+    (modules, builtins, threads) outlives it, but the modules imported up front are shared
+    """
+    # the workers inherit the parent's memory, which is only possible with fork
+    _context = multiprocessing.get_context("fork")
+
+    def __init__(self):
+        # fds of the zygote that the workers close right after the fork
+        self.private_fds: list[int] = []
+
+    def run(self, user_code: str, blacklist: list[ForbiddenMethod], timeout_seconds, track_memory=False) -> CodeResult:
+        _warm_caches(user_code, blacklist)
+
+        result_read, result_write = os.pipe()
+        process = self._context.Process(
+            target=worker_process,
+            args=(result_write, [result_read, *self.private_fds], user_code, blacklist, track_memory)
+        )
+        process.start()
+        os.close(result_write)
+
+        try:
+            ready, _, _ = select.select([result_read], [], [], timeout_seconds)
+            if not ready:
+                # if there is no result after the timeout, the worker is stuck.
+                return _failed_result("Time Limit Exceeded: Ваш код выполнялся слишком долго.", timeout_seconds)
+            return read_frame(result_read)
+        except (EOFError, OSError):
+            # if the worker crashed fatally (segfault)
+            return _failed_result("System Error: Process crashed", None)
+        finally:
+            # also takes down the threads and processes the submission may have left behind
+            process.kill()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.join()
+            os.close(result_read)
+
+
+_zygote = Zygote()
+
+
+def universal_inspector(user_code: str, blacklist: list[ForbiddenMethod], timeout_seconds=2, track_memory=False) -> CodeResult:
+    return _zygote.run(user_code, blacklist, timeout_seconds, track_memory)
+
+
+def run_job(job: dict, track_memory=False) -> CodeResult:
+    """Runs a job sent by the service: {"code": ..., "config": {...}, "timeout": ...}"""
+    config = job.get("config", {})
+    return universal_inspector(
+        job["code"],
+        config.get("blacklist", []),
+        timeout_seconds=job.get("timeout", 5),
+        track_memory=track_memory or config.get("track_memory", False)
+    )
+
+
+PR_SET_DUMPABLE = 4
+
+
+def _set_undumpable() -> None:
+    """
+    Keeps other processes of the same user (e.g. left behind by a submission)
+    from opening the fds of this process through /proc/<pid>/fd
+    """
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+
+
+def serve(exchange_dir: str, track_memory=False) -> None:
+    """
+    Long-lived mode: takes jobs from the 'request' FIFO in exchange_dir
+    and writes the results to the 'response' FIFO, until the host closes it
+    """
+    # only here: a one-off job would pay for all the imports in its own time
+    preimport_modules()
+    # inherited by the forked workers too
+    _set_undumpable()
+
+    # the host opens the FIFOs in the same order
+    request_fd = os.open(os.path.join(exchange_dir, "request"), os.O_RDONLY)
+    response_fd = os.open(os.path.join(exchange_dir, "response"), os.O_WRONLY)
+    _zygote.private_fds += [request_fd, response_fd]
+
+    while True:
+        try:
+            job = read_frame(request_fd)
+        except EOFError:
+            break
+        write_frame(response_fd, run_job(job, track_memory))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("code_path", help="Path to the student's python file")
-    parser.add_argument("config_path", help="Path to the configuration json")
+    parser.add_argument("job_path", nargs="?", help="Path to the job file written by the service")
+    parser.add_argument("--serve", metavar="EXCHANGE_DIR", help="Serve jobs from the FIFOs in EXCHANGE_DIR")
+    parser.add_argument("--track-memory", action="store_true", help="Always sample memory usage over time")
     args = parser.parse_args()
 
+    if args.serve:
+        serve(args.serve, track_memory=args.track_memory)
+        sys.exit(0)
+    if not args.job_path:
+        parser.error("job_path is required without --serve")
+
     try:
-        with open(args.code_path, 'r', encoding="utf-8") as f:
-            user_code = f.read()
-    except FileNotFoundError:
+        job_fd = os.open(args.job_path, os.O_RDONLY)
+        try:
+            job = read_frame(job_fd)
+        finally:
+            os.close(job_fd)
+    except (OSError, EOFError, ValueError) as e:
         print(json.dumps({
             "success": False,
-            "error": f"System Error: Code file not found at {args.code_path}",
+            "error": f"System Error: Could not read the job at {args.job_path}: {e}",
             "output": "",
             "truncated": False,
             "memory_peak_mb": 0,
+            "memory_timeline": None,
             "execution_time": 0,
             "variables": {},
             "system_error": "",
@@ -273,13 +506,6 @@ if __name__ == "__main__":
         }, ensure_ascii=False))
         sys.exit(1)
 
-    try:
-        with open(args.config_path, 'r', encoding="utf-8") as f:
-            config = json.load(f)
-            blacklist = config.get("blacklist", [])
-    except Exception:
-        blacklist = []
-
-    result = universal_inspector(user_code, blacklist, timeout_seconds=5)
+    result = run_job(job, track_memory=args.track_memory)
 
     print(json.dumps(result, ensure_ascii=False))
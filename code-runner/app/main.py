@@ -1,11 +1,11 @@
 import logging
 import os
-import asyncio
-import docker
+import io
+import tarfile
 from faststream import FastStream
 from faststream.rabbit import RabbitBroker, RabbitQueue, RabbitExchange, ExchangeType
 from app.schemas import ExecutionRequest
-from app.services.docker_manager import run_code_in_docker
+from app.services.docker_manager import run_code_in_docker, pool, watcher, get_docker, close_docker
 
 
 logging.basicConfig(level=logging.INFO)
@@ -28,53 +28,79 @@ async def setup_infrastructure():
     await broker.declare_queue(jobs_queue)
 
     await build_agent_image()
+    await start_sandbox_pool()
+
+
+@app.after_shutdown
+async def shutdown_sandboxes():
+    await pool.stop()
+    # otherwise it reconnects with a new client once the old one is closed
+    await watcher.stop()
+    await close_docker()
 
 
 async def build_agent_image():
     logger.info("Connecting to Docker Daemon...")
     try:
-        client = docker.from_env()
+        docker = get_docker()
         if not os.path.exists(AGENT_PATH):
             logger.error(f"Agent path not found: {AGENT_PATH}")
             return
-        
+
         logger.info(f"Building sandbox image from {AGENT_PATH}...")
 
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, lambda: client.images.build(
-            path=AGENT_PATH,
+        # the API takes the build context as a tar archive
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode="w:gz") as tar:
+            tar.add(AGENT_PATH, arcname=".")
+        context.seek(0)
+
+        await docker.images.build(
+            fileobj=context,
+            encoding="gzip",
             tag="my-ds-runner:latest",
-            dockerfile="Dockerfile.agent",
+            path_dockerfile="Dockerfile.agent",
             rm=True
-        ))
+        )
         logger.info("Sandbox image 'my-ds-runner:latest' built successfully!")
     except Exception as e:
         logger.critical(f"Failed to build Docker image: {e}")
 
 
+async def start_sandbox_pool():
+    if pool.size == 0:
+        logger.info("Sandbox pool disabled, using a container per submission")
+        # subscribe to container events before the first job starts a container
+        watcher.start()
+        return
+
+    logger.info(f"Starting {pool.size} sandbox containers...")
+    try:
+        await pool.start()
+        logger.info("Sandbox pool is ready!")
+    except Exception as e:
+        logger.critical(f"Failed to start sandbox pool: {e}")
+
+
 @broker.subscriber(jobs_queue)
 async def process_job(payload: ExecutionRequest) -> None:
     logger.info(f"Received job: {payload.submission_id}")
 
     try:
-        loop = asyncio.get_running_loop()
-
         # run docker
-        result = await loop.run_in_executor( 
-            None,
-            lambda: run_code_in_docker(
-                submission_id=payload.submission_id,
-                user_code=payload.code,
-                config=payload.config.model_dump(),
-                timeout=payload.timeout
-            )
+        result = await run_code_in_docker(
+            submission_id=payload.submission_id,
+            user_code=payload.code,
+            config=payload.config.model_dump(),
+            timeout=payload.timeout
         )
 
-        # send the result to RabbitMQ
+        # send the result to RabbitMQ, serialized by pydantic-core in one pass
         await broker.publish(
-            result.model_dump(),
+            result.model_dump_json().encode(),
             exchange=result_exchange,
-            routing_key="result"
+            routing_key="result",
+            content_type="application/json"
         )
 
         if result.success:
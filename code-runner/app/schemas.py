@@ -9,6 +9,7 @@ class ForbiddenRule(BaseModel):
 
 class ExecutionConfig(BaseModel):
     blacklist: List[ForbiddenRule] = []
+    track_memory: bool = False
 
 class ExecutionRequest(BaseModel):
     submission_id: str = Field(..., description="Code submission id from Kotlin")
@@ -31,6 +32,7 @@ class ExecutionResult(BaseModel):
     error: Optional[str] = None
     truncated: bool = False
     memory_peak_mb: Optional[float] = None
+    memory_timeline: Optional[list[tuple[float, float]]] = None
     execution_time: Optional[float] = None
     variables: Optional[Dict[str, VariableInfo]] = None
     system_error: Optional[str] = None
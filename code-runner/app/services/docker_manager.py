@@ -1,90 +1,438 @@
-import docker
+import aiodocker
+import asyncio
+import orjson
 import os
 import json
+import errno
 import logging
 import shutil
+from typing import Optional
+from aiodocker.events import DockerEvents
 from app.schemas import ExecutionResult
 
 logger = logging.getLogger(__name__)
-client = docker.from_env()
 
 EXCHANGE_DIR = os.getenv("EXCHANGE_DIR", "/exchange")
 EXCHANGE_VOLUME_NAME = os.getenv("EXCHANGE_VOLUME_NAME", "code-exchange")
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "2"))
+SANDBOX_MAX_JOBS = int(os.getenv("SANDBOX_MAX_JOBS", "100"))
 
-def run_code_in_docker(submission_id: str, user_code: str, config: dict, timeout: int) -> ExecutionResult:
+SANDBOX_IMAGE = "my-ds-runner:latest"
+SANDBOX_LABEL = "ise.sandbox"
+STARTUP_TIMEOUT = 30
+
+# one-off jobs go into their own part of the exchange volume, away from the FIFOs
+JOBS_SUBDIR = "jobs"
+# 'student' in Dockerfile.agent
+STUDENT_UID = 1000
+# warm sandboxes run as 10000 + worker_id, so each one owns only its FIFOs
+WORKER_UID_BASE = 10_000
+
+_docker: Optional[aiodocker.Docker] = None
+
+
+class SandboxStartupError(Exception):
+    """A sandbox container could not be started: a failure of the service, not of the submitted code"""
+
+
+def get_docker() -> aiodocker.Docker:
+    """One client for the whole service, created inside the running event loop"""
+    global _docker
+    if _docker is None:
+        _docker = aiodocker.Docker()
+    return _docker
+
+
+async def close_docker() -> None:
+    global _docker
+    if _docker is not None:
+        await _docker.close()
+        _docker = None
+
+
+def sandbox_config(command: list[str], subdir: str, uid: int = STUDENT_UID, labels: Optional[dict] = None) -> dict:
+    """
+    Container config with the limits and isolation settings shared by every sandbox.
+    Only the given subdirectory of the exchange volume is mounted, as /exchange.
+    """
+    return {
+        "Image": SANDBOX_IMAGE,
+        "Cmd": command,
+        "User": f"{uid}:{uid}",
+        "NetworkDisabled": True,
+        "Labels": labels or {},
+        "HostConfig": {
+            "Mounts": [{
+                "Type": "volume",
+                "Source": EXCHANGE_VOLUME_NAME,
+                "Target": "/exchange",
+                "ReadOnly": True,
+                "VolumeOptions": {"Subpath": subdir},
+            }],
+            # an init process as PID 1 reaps the orphans of submissions
+            "Init": True,
+            "Memory": 256 * 1024 * 1024,
+            "PidsLimit": 20,
+            "CpuQuota": 50_000,
+            "ReadonlyRootfs": True,
+            "CapDrop": ["ALL"],
+            "Tmpfs": {"/tmp": "size=10m,noexec,nosuid"},
+        },
+    }
+
+
+# FIFO PROTOCOL
+# Every message is [u32 little-endian length][json payload], same as agent/utils.py
+
+def _encode_frame(obj) -> bytes:
+    payload = orjson.dumps(obj)
+    return len(payload).to_bytes(4, 'little') + payload
+
+
+def _write_frame(fd: int, obj) -> None:
+    data = memoryview(_encode_frame(obj))
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    try:
+        size = int.from_bytes(await reader.readexactly(4), 'little')
+        return orjson.loads(await reader.readexactly(size))
+    except asyncio.IncompleteReadError:
+        raise EOFError("Sandbox container exited unexpectedly")
+
+
+async def _open_writer(path: str, deadline: float) -> int:
+    """Opens the write end of a FIFO once the container has opened the read end"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO: nobody is reading yet
+            if e.errno != errno.ENXIO:
+                raise
+            if loop.time() > deadline:
+                raise TimeoutError("Sandbox container did not start in time")
+            await asyncio.sleep(0.05)
+
+
+# CONTAINER EVENTS
+
+class ContainerWatcher:
+    """
+    Follows the Docker events stream in a single task and resolves a future
+    when a watched container dies, instead of a long-polling wait per container
+    """
+    def __init__(self):
+        self._pending: dict[str, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            events = DockerEvents(get_docker())
+            subscriber = events.subscribe(filters=json.dumps({"type": ["container"], "event": ["die"]}))
+            try:
+                # None marks the end of the stream
+                while (event := await subscriber.get()) is not None:
+                    # Actor.ID, the top-level "id" is deprecated
+                    actor = event.get("Actor", {})
+                    future = self._pending.pop(actor.get("ID"), None)
+                    if future and not future.done():
+                        future.set_result(int(actor.get("Attributes", {}).get("exitCode", -1)))
+            finally:
+                try:
+                    await events.stop()
+                except Exception as e:
+                    logger.warning(f"Docker events stream failed: {e}")
+            logger.warning("Docker events stream closed, reconnecting")
+            await asyncio.sleep(1)
+
+    async def stop(self) -> None:
+        """Stops following the events, before the Docker client is closed"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def watch(self, container_id: str) -> asyncio.Future:
+        """Must be called before the container is started"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[container_id] = future
+        return future
+
+    def forget(self, container_id: str) -> None:
+        self._pending.pop(container_id, None)
+
+
+watcher = ContainerWatcher()
+
+
+async def _read_output(stream) -> bytes:
+    """Collects everything the container writes until it exits"""
+    output = bytearray()
+    while (message := await stream.read_out()) is not None:
+        output += message.data
+    return bytes(output)
+
+
+# WARM POOL
+
+class SandboxWorker:
+    """A long-lived sandbox container and the FIFOs used to send it jobs"""
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.subdir = f"worker_{worker_id}"
+        self.uid = WORKER_UID_BASE + worker_id
+        self.container = None
+        self.jobs_served = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._read_transport = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def start(self) -> None:
+        host_dir = os.path.join(EXCHANGE_DIR, self.subdir)
+        shutil.rmtree(host_dir, ignore_errors=True)
+        os.makedirs(host_dir)
+        # the FIFOs are a write path into the service, only this sandbox may open them
+        os.chown(host_dir, self.uid, self.uid)
+        os.chmod(host_dir, 0o700)
+        for name in ("request", "response"):
+            fifo_path = os.path.join(host_dir, name)
+            os.mkfifo(fifo_path)
+            os.chown(fifo_path, self.uid, self.uid)
+            os.chmod(fifo_path, 0o600)
+
+        self.container = await get_docker().containers.run(
+            config=sandbox_config(
+                ["python", "/app/inspector.py", "--serve", "/exchange"],
+                self.subdir,
+                uid=self.uid,
+                labels={SANDBOX_LABEL: self.subdir}
+            )
+        )
+
+        # same order as inspector.serve: request first, then response
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STARTUP_TIMEOUT
+        response_fd = os.open(os.path.join(host_dir, "response"), os.O_RDONLY | os.O_NONBLOCK)
+        self._reader = asyncio.StreamReader()
+        self._read_transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self._reader),
+            os.fdopen(response_fd, "rb", buffering=0)
+        )
+        request_fd = await _open_writer(os.path.join(host_dir, "request"), deadline)
+        write_transport, write_protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin,
+            os.fdopen(request_fd, "wb", buffering=0)
+        )
+        self._writer = asyncio.StreamWriter(write_transport, write_protocol, None, loop)
+        self.jobs_served = 0
+        logger.info(f"Sandbox {self.subdir} is ready")
+
+    async def stop(self) -> None:
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._read_transport:
+            self._read_transport.close()
+            self._read_transport = None
+        self._reader = None
+        if self.container:
+            try:
+                await self.container.delete(force=True)
+            except Exception:
+                pass
+            self.container = None
+
+    async def _exchange(self, job: dict) -> dict:
+        self._writer.write(_encode_frame(job))
+        await self._writer.drain()
+        return await _read_frame(self._reader)
+
+    async def run(self, job: dict, timeout: float) -> dict:
+        data = await asyncio.wait_for(self._exchange(job), timeout)
+        self.jobs_served += 1
+        return data
+
+
+class SandboxPool:
+    """
+    Keeps sandbox containers running between submissions,
+    so that a submission doesn't pay for starting a container
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._workers: list[SandboxWorker] = []
+        self._idle: asyncio.Queue[SandboxWorker] = asyncio.Queue()
+        self._restarts: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        docker = get_docker()
+        # containers left over from a previous run of the service
+        stale = await docker.containers.list(all=True, filters=json.dumps({"label": [SANDBOX_LABEL]}))
+        for container in stale:
+            await container.delete(force=True)
+
+        self._workers = [SandboxWorker(worker_id) for worker_id in range(self.size)]
+        results = await asyncio.gather(*(worker.start() for worker in self._workers), return_exceptions=True)
+        for worker, result in zip(self._workers, results):
+            if isinstance(result, BaseException):
+                # it will be started again on the first job
+                logger.error(f"Failed to start sandbox {worker.subdir}: {result}")
+                await worker.stop()
+            self._idle.put_nowait(worker)
+
+    async def stop(self) -> None:
+        for task in self._restarts:
+            task.cancel()
+        await asyncio.gather(*self._restarts, return_exceptions=True)
+        for worker in self._workers:
+            await worker.stop()
+        self._workers = []
+        self._idle = asyncio.Queue()
+
+    def _restart(self, worker: SandboxWorker) -> None:
+        """Replaces the container of a worker in the background, the worker is idle again once it is ready"""
+        task = asyncio.create_task(self._replace(worker))
+        # the loop only keeps weak references to tasks
+        self._restarts.add(task)
+        task.add_done_callback(self._restarts.discard)
+
+    async def _replace(self, worker: SandboxWorker) -> None:
+        await worker.stop()
+        try:
+            await worker.start()
+        except Exception as e:
+            # it will be started again on its next job
+            logger.error(f"Failed to restart sandbox {worker.subdir}: {e}")
+            await worker.stop()
+        self._idle.put_nowait(worker)
+
+    async def run(self, job: dict, timeout: float) -> dict:
+        # waits until a sandbox is free
+        worker = await self._idle.get()
+        try:
+            if worker.container is None:
+                try:
+                    await worker.start()
+                except Exception as e:
+                    raise SandboxStartupError(f"Sandbox {worker.subdir} failed to start: {e}") from e
+            data = await worker.run(job, timeout)
+        except BaseException:
+            # a stuck or dead sandbox is replaced off the path of the next job
+            self._restart(worker)
+            raise
+
+        # recycle now and then, so that submissions can't leave state behind for long
+        if worker.jobs_served >= SANDBOX_MAX_JOBS:
+            self._restart(worker)
+        else:
+            self._idle.put_nowait(worker)
+        return data
+
+
+pool = SandboxPool(SANDBOX_POOL_SIZE)
+
+
+async def run_code_in_docker(submission_id: str, user_code: str, config: dict, timeout: int) -> ExecutionResult:
+    """
+    Runs the code in a warm sandbox container and returns the results.
+    Falls back to a container per submission when the pool is disabled.
+    """
+    if pool.size == 0:
+        return await run_code_in_new_container(submission_id, user_code, config, timeout)
+
+    job = {"code": user_code, "config": config, "timeout": timeout}
+    try:
+        data = await pool.run(job, timeout=timeout + 2)
+    except TimeoutError:
+        return ExecutionResult(
+            submission_id=submission_id,
+            success=False,
+            output="",
+            error="Docker Container Timeout"
+        )
+    except Exception as e:
+        logger.error(f"Docker execution failed for submission {submission_id}: {e}")
+        return ExecutionResult(
+            submission_id=submission_id,
+            success=False,
+            output="",
+            system_error=str(e)
+        )
+
+    data['submission_id'] = submission_id
+    return ExecutionResult(**data)
+
+
+async def run_code_in_new_container(submission_id: str, user_code: str, config: dict, timeout: int) -> ExecutionResult:
     """
     Runs the code in the container and returns a dictionary with the results.
     Ensures that the container is removed.
     """
     container = None
-    temp_dir = None
+    job_path = None
     try:
-        # create a common volume
-        temp_dir = os.path.join(EXCHANGE_DIR, f"submission_{submission_id}")
-        os.makedirs(temp_dir, exist_ok=True)
-        os.chmod(temp_dir, 0o777)
-
-        # load the user's code
-        host_file_path = os.path.join(temp_dir, "student_solution.py")
-        with open(host_file_path, "w", encoding="utf-8") as f:
-            f.write(user_code)
-        os.chmod(host_file_path, 0o666)
-        
-        # load the config
-        config_path = os.path.join(temp_dir, "config.json")
-        with open(config_path, "w", encoding="utf-8") as f:
-            json.dump(config, f)
-        os.chmod(config_path, 0o666)
-        
-        mem_limit = "256m"
-        pids_limit = 20
-        cpu_quota = 50_000
-
-        volumes={
-                EXCHANGE_VOLUME_NAME: {'bind': '/exchange', 'mode': 'ro'}
-            }
-
-        submission_subdir = f"submission_{submission_id}"
-        container = client.containers.run(
-            image="my-ds-runner:latest",
-            command=["python", "/app/inspector.py", f"/exchange/{submission_subdir}/student_solution.py", f"/exchange/{submission_subdir}/config.json"],
-            volumes=volumes,
-            mem_limit=mem_limit,
-            pids_limit=pids_limit,
-            cpu_quota=cpu_quota,
-            network_disabled=True,
-            detach=True,
-            user="student",
-            read_only=True,
-            cap_drop=["ALL"],
-            tmpfs={'/tmp': 'size=10m,noexec,nosuid'}
+        # the whole job goes into a single file on the (tmpfs) exchange volume
+        job_name = f"submission_{submission_id}.job"
+        jobs_dir = os.path.join(EXCHANGE_DIR, JOBS_SUBDIR)
+        os.makedirs(jobs_dir, exist_ok=True)
+        job_path = os.path.join(jobs_dir, job_name)
+        job = {"code": user_code, "config": config, "timeout": timeout}
+        # created readable for 'student' right away, no chmod needed
+        fd = os.open(job_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _write_frame(fd, job)
+        finally:
+            os.close(fd)
+
+        container = await get_docker().containers.create(
+            config=sandbox_config(["python", "/app/inspector.py", f"/exchange/{job_name}"], JOBS_SUBDIR)
         )
+        exited = watcher.watch(container.id)
+        # attached before the start, so the output is read while the code runs
+        async with container.attach(stdout=True, stderr=True, logs=True) as stream:
+            await container.start()
+            output = asyncio.create_task(_read_output(stream))
 
-        try:
-            result = container.wait(timeout=timeout + 2)
-        except Exception:
-            container.kill()
-            return ExecutionResult(
-                submission_id=submission_id,
-                success=False,
-                output="",
-                error="Docker Container Timeout"
-            )
-        
-        logs = container.logs().decode("utf-8", errors="replace")
+            try:
+                await asyncio.wait_for(exited, timeout + 2)
+            except TimeoutError:
+                # the event may have been missed while the stream was reconnecting
+                info = await container.show()
+                if info["State"]["Running"]:
+                    output.cancel()
+                    await container.kill()
+                    return ExecutionResult(
+                        submission_id=submission_id,
+                        success=False,
+                        output="",
+                        error="Docker Container Timeout"
+                    )
+
+            # the stream ends right after the container exits
+            logs = await output
 
         try:
-            data = json.loads(logs)
+            data = orjson.loads(logs)
             data['submission_id'] = submission_id
             return ExecutionResult(**data)
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             return ExecutionResult(
                 submission_id=submission_id,
                 success=False,
-                output=logs[:1000],
+                output=logs[:1000].decode(errors="replace"),
                 system_error="Invalid JSON from inspector"
             )
-        
+
     except Exception as e:
         logger.error(f"Docker execution failed for submission {submission_id}: {e}")
         return ExecutionResult(
@@ -96,15 +444,15 @@ def run_code_in_docker(submission_id: str, user_code: str, config: dict, timeout
     finally:
         # Cleaning
         if container:
+            watcher.forget(container.id)
             try:
-                container.remove(force=True)
+                await container.delete(force=True)
             except Exception:
                 pass
-        if temp_dir:
+        if job_path:
             try:
-                # Remove temporary files
-                if os.path.exists(temp_dir):
-                    shutil.rmtree(temp_dir, ignore_errors=True)
+                os.unlink(job_path)
+            except FileNotFoundError:
+                pass
             except Exception as e:
-                logger.warning(f"Failed to cleanup temp dir: {e}")
-        
+                logger.warning(f"Failed to cleanup job file: {e}")